@@ -1,7 +1,7 @@
 """
 E-Commerce Churn Prediction - Customer Segmentation
 Purpose: Unsupervised clustering for business persona creation (RFM only)
-Input: data/processed/customers_features.csv
+Input: data/processed/customers_features.parquet
 Output: data/processed/customer_segments.csv
 Architecture: K-Means on log-transformed RFM features.
                Log-transform (np.log1p) compresses monetary outliers before
@@ -33,7 +33,7 @@ config_path = Path(__file__).parent.parent.parent / "config" / "config.yaml"
 with open(config_path, 'r') as f:
     config = yaml.safe_load(f)
 
-FEATURES_PATH = Path(config['paths']['processed_data']) / "customers_features.csv"
+FEATURES_PATH = Path(config['paths']['processed_data']) / "customers_features.parquet"
 OUTPUT_PATH = Path(config['paths']['processed_data']) / "customer_segments.csv"
 RANDOM_STATE = config['modeling']['random_state']
 
@@ -44,7 +44,7 @@ log_info("Configuration loaded successfully")
 
 log_info("Loading customer features...")
 
-df = pd.read_csv(FEATURES_PATH)
+df = pd.read_parquet(FEATURES_PATH)
 
 rfm_features = ['recency', 'frequency', 'monetary_gross']
 X_rfm = df[rfm_features].copy()
@@ -1,23 +1,29 @@
 """
 E-Commerce Churn Prediction - Feature Engineering Pipeline
 Purpose: Transform transaction data into customer-level features for ML modeling
-Input: data/interim/cleaned_retail_data.csv (transaction-level)
-Output: data/processed/customers_features.csv (customer-level)
+Input: data/interim/cleaned_retail_data.csv (transaction-level, cached as .parquet)
+Output: data/processed/customers_features.parquet (customer-level, plus .csv copy)
 Version: 1.0 (Simple feature set)
 """
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import yaml
 from pathlib import Path
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # Add src directory to path for imports
 sys.path.append(str(Path(__file__).parent.parent))
 from python.utils import (
-    log_info, log_warn, log_error,
+    log_info, log_warn, log_error, flush_logs,
     validate_date_column, validate_no_missing_values,
-    check_data_leakage, generate_feature_report, split_by_time_window
+    check_data_leakage, generate_feature_report, split_by_time_window,
+    count_distinct_per_group
 )
 
 
@@ -33,31 +39,83 @@ OBS_END = config['features']['observation_end']
 OUTCOME_START = config['features']['outcome_start']
 OUTCOME_END = config['features']['outcome_end']
 
+# Cohort eligibility criteria from config
+MIN_TENURE_DAYS = config['features']['min_tenure_days']
+MIN_FREQUENCY = config['features']['min_frequency']
+
+# Window boundaries parsed once and reused by every step below
+OBS_END_TS = pd.Timestamp(OBS_END)
+OUT_START_TS = pd.Timestamp(OUTCOME_START)
+MIN_ACQ_TS = OBS_END_TS - pd.Timedelta(days=MIN_TENURE_DAYS)
+
 # File paths
 CLEANED_DATA_PATH = Path(config['paths']['interim_data']) / "cleaned_retail_data.csv"
+CLEANED_PARQUET_PATH = CLEANED_DATA_PATH.with_suffix('.parquet')
 OUTPUT_PATH = Path(config['paths']['processed_data']) / "customers_features.csv"
+OUTPUT_PARQUET_PATH = OUTPUT_PATH.with_suffix('.parquet')
+
+# Only columns the pipeline reads are loaded (description, country and the
+# R temporal helpers would otherwise ride along through every groupby)
+USECOLS = [
+    'invoice', 'stock_code', 'customer_id', 'quantity',
+    'price', 'total_amount', 'is_return', 'invoice_date'
+]
+
+# Narrow numeric dtypes halve the bytes moved by every reduction. total_amount
+# stays float64: it feeds the monetary sums, which need more than float32's
+# ~7 significant digits to stay exact to the penny on large accounts.
+NARROW_DTYPES = {'quantity': 'int32', 'price': 'float32'}
 
 log_info("Configuration loaded successfully")
 
 
 # --- Step 1: Load Cleaned Transaction Data ---
-# Read CSV with proper data types to prevent parsing issues
+# The R pipeline exports CSV; on first run it is parsed with the multithreaded
+# PyArrow engine and cached as a columnar Parquet sidecar. Later runs read the
+# sidecar directly (no text parsing), rebuilding it whenever the CSV is newer
+# or its schema lacks a column or the narrow dtypes.
 
 log_info("Loading cleaned transaction data...")
 
-df = pd.read_csv(
-    CLEANED_DATA_PATH,
-    parse_dates=['invoice_date', 'invoice_date_only'],
-    dtype={
-        'invoice': str,
-        'stock_code': str,
-        'customer_id': int,
-        'quantity': int,
-        'price': float,
-        'country': str
-    }
+parquet_is_fresh = CLEANED_PARQUET_PATH.exists() and (
+    not CLEANED_DATA_PATH.exists() or
+    CLEANED_PARQUET_PATH.stat().st_mtime >= CLEANED_DATA_PATH.stat().st_mtime
 )
 
+if parquet_is_fresh:
+    cached_schema = pq.read_schema(CLEANED_PARQUET_PATH)
+    parquet_is_fresh = set(USECOLS) <= set(cached_schema.names) and all(
+        cached_schema.field(col).type == pa.type_for_alias(dtype)
+        for col, dtype in NARROW_DTYPES.items()
+    )
+
+if parquet_is_fresh:
+    df = pd.read_parquet(
+        CLEANED_PARQUET_PATH, engine='pyarrow', columns=USECOLS, use_threads=True
+    )
+else:
+    # Explicit dtypes prevent purely numeric stock codes being inferred as int
+    df = pd.read_csv(
+        CLEANED_DATA_PATH,
+        engine='pyarrow',
+        usecols=USECOLS,
+        parse_dates=['invoice_date'],
+        dtype={
+            'invoice': str,
+            'stock_code': str,
+            'customer_id': int,
+            'quantity': int,
+            'price': float
+        }
+    ).astype(NARROW_DTYPES)
+    df.to_parquet(CLEANED_PARQUET_PATH, engine='pyarrow', index=False)
+    log_info(f"Parquet cache written: {CLEANED_PARQUET_PATH}")
+
+# Identifier columns become categoricals once: every downstream groupby,
+# nunique and membership test then hashes int32 codes instead of objects
+for col in ('customer_id', 'invoice', 'stock_code'):
+    df[col] = df[col].astype('category')
+
 log_info(f"Data loaded: {len(df):,} transactions")
 
 # Validate critical columns
@@ -71,8 +129,8 @@ validate_no_missing_values(df, ['customer_id', 'invoice_date', 'quantity', 'pric
 
 observation_df, outcome_df = split_by_time_window(
     df, 
-    observation_end=OBS_END,
-    outcome_start=OUTCOME_START
+    observation_end=OBS_END_TS,
+    outcome_start=OUT_START_TS
 )
 
 check_data_leakage(observation_df, outcome_df)
@@ -96,38 +154,96 @@ log_info(f"Outcome: {len(outcome_df):,} transactions")
 
 log_info("Applying cohort eligibility criteria...")
 
-# Load eligibility criteria from config
-MIN_TENURE_DAYS = config['features']['min_tenure_days']
-MIN_FREQUENCY = config['features']['min_frequency']
-
-obs_end_date = pd.to_datetime(OBS_END)
-min_acquisition_date = obs_end_date - pd.Timedelta(days=MIN_TENURE_DAYS)
+# Precompute masked columns once so every per-customer metric below is a
+# builtin groupby reduction (no Python-level lambdas per group)
+quantity = observation_df['quantity'].to_numpy()
+observation_df['is_purchase'] = quantity > 0
+observation_df['gross_qty'] = np.where(quantity > 0, quantity, 0)
+observation_df['purchase_invoice'] = observation_df['invoice'].where(
+    observation_df['is_purchase']
+)
+total_amount = observation_df['total_amount'].to_numpy()
+observation_df['gross_amount'] = np.where(total_amount > 0, total_amount, 0.0)
+observation_df['return_amount'] = np.where(
+    observation_df['is_return'].to_numpy(), -total_amount, 0.0
+)
+observation_df['return_invoice'] = observation_df['invoice'].where(
+    observation_df['is_return']
+)
 
-# Calculate customer acquisition dates and transaction counts
-customer_stats = observation_df.groupby('customer_id').agg(
+# Single consolidated pass: eligibility stats, RFM, behavioral and return
+# aggregates are all independent of the eligibility filter (it drops whole
+# customers), so they share one groupby over the observation window.
+# sort=False skips sorting the group keys here (intermediate steps align on
+# the customer_id index; the final feature table is sorted once in Step 8);
+# observed=True keeps the categorical key from reindexing over customers
+# absent from the window.
+#
+# Distinct counts are computed from sorted categorical code pairs instead of
+# groupby nunique (which builds a hash set per customer). They are indexed
+# by customer_id code and gathered into customer_stats row order.
+#
+# The groupby and the four distinct counts are independent and their pandas
+# and numpy kernels release the GIL, so on multi-core hosts they run
+# concurrently on a thread pool; on a single core the pool only adds
+# overhead and they run serially. Column arguments are bound on the main
+# thread, so workers never index observation_df concurrently.
+distinct_counts = {
+    'frequency': 'invoice',  # Count unique invoices (purchases + returns)
+    'unique_products': 'stock_code',
+    'n_purchase_invoices': 'purchase_invoice',
+    'n_return_invoices': 'return_invoice'
+}
+
+aggregation_tasks = {
+    feature: partial(
+        count_distinct_per_group, observation_df['customer_id'], observation_df[col]
+    )
+    for feature, col in distinct_counts.items()
+}
+aggregation_tasks['customer_stats'] = partial(
+    observation_df.groupby('customer_id', sort=False, observed=True).agg,
     first_purchase=('invoice_date', 'min'),
-    n_transactions=('invoice', 'nunique')
+    last_purchase=('invoice_date', 'max'),
+    monetary_net=('total_amount', 'sum'),  # Net revenue (can be negative)
+    monetary_gross=('gross_amount', 'sum'),  # Purchases only
+    n_purchase_lines=('is_purchase', 'sum'),
+    gross_qty=('gross_qty', 'sum'),  # Units bought (purchase lines only)
+    return_amount=('return_amount', 'sum')  # Already sign-flipped (positive)
 )
 
-# Apply hybrid filter
-eligible_customers = customer_stats[
-    (customer_stats['first_purchase'] <= min_acquisition_date) &  # Tenure >= 90 days
-    (customer_stats['n_transactions'] >= MIN_FREQUENCY)            # Frequency >= 2
-].index
+if (os.cpu_count() or 1) > 1:
+    with ThreadPoolExecutor(max_workers=len(aggregation_tasks)) as pool:
+        futures = {name: pool.submit(task) for name, task in aggregation_tasks.items()}
+        aggregation_results = {name: future.result() for name, future in futures.items()}
+else:
+    aggregation_results = {name: task() for name, task in aggregation_tasks.items()}
+
+customer_stats = aggregation_results['customer_stats']
+stats_codes = customer_stats.index.codes
+for feature in distinct_counts:
+    customer_stats[feature] = aggregation_results[feature][stats_codes]
+
+# Both criteria are evaluated once as numpy masks over customer_stats; the
+# hybrid filter and the breakdown counts below are reductions over them
+tenure_fail = customer_stats['first_purchase'].to_numpy() > MIN_ACQ_TS.to_datetime64()
+frequency_fail = customer_stats['frequency'].to_numpy() < MIN_FREQUENCY
+
+# Apply hybrid filter: tenure >= 90 days and frequency >= 2
+eligible_mask = ~(tenure_fail | frequency_fail)
 
 # Log filtering breakdown for transparency
 n_total = len(customer_stats)
-n_tenure_fail = (customer_stats['first_purchase'] > min_acquisition_date).sum()
-n_frequency_fail = (customer_stats['n_transactions'] < MIN_FREQUENCY).sum()
-n_both_fail = (
-    (customer_stats['first_purchase'] > min_acquisition_date) &
-    (customer_stats['n_transactions'] < MIN_FREQUENCY)
-).sum()
-
-# Update observation dataframe to only eligible customers
-observation_df = observation_df[
-    observation_df['customer_id'].isin(eligible_customers)
-]
+n_tenure_fail = tenure_fail.sum()
+n_frequency_fail = frequency_fail.sum()
+n_both_fail = (tenure_fail & frequency_fail).sum()
+
+# Eligibility is applied to the per-customer aggregates rather than by
+# re-filtering the transaction frame: every metric is computed per customer,
+# so ineligible customers simply drop out at the customer level. Selecting
+# by the mask avoids a label lookup of the eligible ids against the index.
+eligible_stats = customer_stats[eligible_mask]
+eligible_customers = eligible_stats.index
 
 n_eligible = len(eligible_customers)
 filtered_out = n_total - n_eligible
@@ -150,14 +266,13 @@ log_info(f"    - Failed both: {n_both_fail:,}")
 
 log_info("Calculating RFM metrics...")
 
-obs_end_date = pd.to_datetime(OBS_END)
-
-rfm = observation_df.groupby('customer_id').agg(
-    recency=('invoice_date', lambda x: (obs_end_date - x.max()).days),
-    frequency=('invoice', 'nunique'),  # Count unique invoices (purchases + returns)
-    monetary_net=('total_amount', 'sum'),  # Net revenue (can be negative)
-    monetary_gross=('total_amount', lambda x: x[x > 0].sum())  # Purchases only
-).reset_index()
+# Recency is one vectorized timedelta subtract over the per-customer maxima
+rfm = pd.DataFrame({
+    'recency': (OBS_END_TS - eligible_stats['last_purchase']).dt.days.astype('int32'),
+    'frequency': eligible_stats['frequency'],
+    'monetary_net': eligible_stats['monetary_net'],
+    'monetary_gross': eligible_stats['monetary_gross']
+})
 
 
 # --- Step 5: Calculate Behavioral Features ---
@@ -169,88 +284,59 @@ log_info("Calculating behavioral features...")
 # avg_items_per_basket: Total items per checkout event (engagement proxy)
 # avg_units_per_line: Average quantity per product line (bulk buying intent)
 
-# Calculate true basket size (sum quantities per invoice)
-basket_sizes = observation_df[observation_df['quantity'] > 0].groupby(
-    ['customer_id', 'invoice']
-)['quantity'].sum()
-
-basket_metrics = pd.DataFrame({
-    'customer_id': basket_sizes.groupby('customer_id').groups.keys(),
-    'avg_items_per_basket': basket_sizes.groupby('customer_id').mean(),
-    'avg_units_per_line': observation_df[observation_df['quantity'] > 0].groupby(
-        'customer_id'
-    )['quantity'].mean()
-}).reset_index(drop=True)
+# Both are ratios of purchase-line totals from the consolidated groupby, so
+# no per-invoice basket groupby is needed: the mean of per-invoice quantity
+# sums equals total units over the number of purchase invoices. Customers
+# without purchase lines get NaN here (filled with 0 in Step 8).
+avg_items_per_basket = eligible_stats['gross_qty'] / eligible_stats['n_purchase_invoices']
+avg_units_per_line = eligible_stats['gross_qty'] / eligible_stats['n_purchase_lines']
 
 # --- Core Behavioral Features ---
-behavioral = observation_df.groupby('customer_id').agg(
-    unique_products=('stock_code', 'nunique'),
-    first_purchase_date=('invoice_date', 'min'),
-    last_purchase_date=('invoice_date', 'max')
-).reset_index()
-
-# Merge basket metrics
-behavioral = behavioral.merge(basket_metrics, on='customer_id', how='left')
+behavioral = pd.DataFrame({
+    'unique_products': eligible_stats['unique_products'],
+    'first_purchase_date': eligible_stats['first_purchase'],
+    'last_purchase_date': eligible_stats['last_purchase'],
+    'avg_items_per_basket': avg_items_per_basket,
+    'avg_units_per_line': avg_units_per_line
+})
 
 # --- Temporal Features ---
 behavioral['days_as_customer'] = (
     (behavioral['last_purchase_date'] - behavioral['first_purchase_date']).dt.days
 )
 
-# Merge with RFM to get frequency for velocity calculation
-behavioral = behavioral.merge(rfm[['customer_id', 'frequency']], on='customer_id')
-
 # Purchase velocity with Laplace smoothing (+1 day to denominator)
 # Prevents asymptotic explosion for same-day burst purchases
 # Formula: frequency / ((days + 1) / 30)
-behavioral['purchase_velocity'] = (
-    behavioral['frequency'] / ((behavioral['days_as_customer'] + 1) / 30)
-)
+# The smoothed span is computed once on the raw arrays and shared by both
+# features (no index alignment or repeated days + 1 temporaries)
+smoothed_days = behavioral['days_as_customer'].to_numpy() + 1.0
+frequency = eligible_stats['frequency'].to_numpy()
 
-# Average days between purchases (with same smoothing)
-behavioral['avg_days_between_purchases'] = (
-    (behavioral['days_as_customer'] + 1) / behavioral['frequency']
-)
+behavioral['purchase_velocity'] = frequency / (smoothed_days / 30)
 
-# Drop temporary frequency column (will merge from RFM later)
-behavioral = behavioral.drop(columns=['frequency'])
+# Average days between purchases (with same smoothing)
+behavioral['avg_days_between_purchases'] = smoothed_days / frequency
 
 
 # --- Step 6: Calculate Return Metrics ---
 # Track return behavior which may correlate with churn
 # FIXED: Invoice-level return rate (dimensionally consistent with frequency)
+# Return invoice counts and amounts come from the consolidated groupby (Step 3)
 
 log_info("Calculating return metrics...")
 
-# Count return invoices (invoices with at least one return line item)
-return_invoices = observation_df[observation_df['is_return']].groupby('customer_id')['invoice'].nunique()
-
-# Total return amount (absolute value for interpretation)
-return_amount = observation_df[observation_df['is_return']].groupby('customer_id')['total_amount'].sum().abs()
-
-# Combine into returns dataframe
 returns = pd.DataFrame({
-    'customer_id': return_invoices.index,
-    'n_return_invoices': return_invoices.values,
-    'return_amount': return_amount.reindex(return_invoices.index, fill_value=0).values
-}).reset_index(drop=True)
-
-# Merge with RFM to get total frequency (invoices)
-returns = returns.merge(rfm[['customer_id', 'frequency']], on='customer_id', how='right')
-
-# Fill missing values (customers with no returns)
-returns['n_return_invoices'] = returns['n_return_invoices'].fillna(0).astype(int)
-returns['return_amount'] = returns['return_amount'].fillna(0)
+    'n_return_invoices': eligible_stats['n_return_invoices'],
+    'return_amount': eligible_stats['return_amount']
+})
 
 # Calculate invoice-level return rate (bounded 0-1)
-returns['return_rate'] = returns['n_return_invoices'] / returns['frequency']
+returns['return_rate'] = returns['n_return_invoices'] / eligible_stats['frequency']
 
 # Boolean flag for any returns
 returns['has_returns'] = returns['n_return_invoices'] > 0
 
-# Drop temporary frequency column
-returns = returns.drop(columns=['frequency'])
-
 
 # --- Step 7: Define Churn Labels ---
 # FIXED: Purchase-only definition (Option 1)
@@ -261,13 +347,17 @@ returns = returns.drop(columns=['frequency'])
 log_info("Defining churn labels...")
 
 # Get customers who made NEW PURCHASES in outcome window (quantity > 0)
-purchase_customers = outcome_df[outcome_df['quantity'] > 0]['customer_id'].unique()
+# Both windows share the customer_id categories, so membership is tested on
+# the int32 codes with numpy's sorted-search isin
+purchase_codes = np.unique(
+    outcome_df.loc[outcome_df['quantity'] > 0, 'customer_id'].cat.codes.to_numpy()
+)
 
 # Create churn labels for all eligible customers
-churn_labels = pd.DataFrame({
-    'customer_id': eligible_customers,
-    'churned': ~pd.Series(eligible_customers).isin(purchase_customers).values
-}).astype({'churned': int})
+churn_labels = pd.DataFrame(
+    {'churned': ~np.isin(eligible_customers.codes, purchase_codes, assume_unique=True)},
+    index=eligible_customers
+).astype({'churned': int})
 
 churn_rate = churn_labels['churned'].mean()
 log_info(f"Churn rate: {churn_rate:.1%} ({churn_labels['churned'].sum():,} churned)")
@@ -275,12 +365,23 @@ log_info(f"Churn rate: {churn_rate:.1%} ({churn_labels['churned'].sum():,} churn
 
 # --- Step 8: Merge All Features ---
 # Combine RFM, behavioral, return metrics, and churn labels
+# All four frames share the eligible customer_id index, so a single
+# index-aligned join replaces the chained hash merges. The aggregation runs
+# unsorted, so rows are sorted by customer_id here: model training's seeded
+# split and segmentation's seeded K-Means depend on the exported row order.
 
 log_info("Merging feature sets...")
 
-features = rfm.merge(behavioral, on='customer_id', how='left')
-features = features.merge(returns, on='customer_id', how='left')
-features = features.merge(churn_labels, on='customer_id', how='left')
+features = (
+    rfm.join([behavioral, returns, churn_labels], how='left')
+    .sort_index()
+    .reset_index()
+)
+
+# Export plain integer ids rather than the categorical used for grouping
+features['customer_id'] = features['customer_id'].astype(
+    df['customer_id'].cat.categories.dtype
+)
 
 # Fill missing basket metrics (customers with no valid purchase quantities)
 features['avg_items_per_basket'] = features['avg_items_per_basket'].fillna(0)
@@ -321,17 +422,26 @@ if neg_monetary > 0:
 # --- Step 10: Generate Feature Report ---
 
 report = generate_feature_report(features)
+flush_logs()  # Keep buffered logs (BATCH_LOG=1) ahead of the report
 print(report)
 
 
 # --- Step 11: Export Features ---
+# Parquet (Snappy) is the modeling input: binary columns, dtypes preserved.
+# The CSV copy is kept for the Streamlit dashboard and manual inspection.
 
 OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
 
+features.to_parquet(
+    OUTPUT_PARQUET_PATH, engine='pyarrow', compression='snappy', index=False
+)
+
+log_info(f"Features exported: {OUTPUT_PARQUET_PATH}")
+log_info(f"File size: {OUTPUT_PARQUET_PATH.stat().st_size / (1024**2):.2f} MB")
+
 features.to_csv(OUTPUT_PATH, index=False)
 
-log_info(f"Features exported: {OUTPUT_PATH}")
-log_info(f"File size: {OUTPUT_PATH.stat().st_size / (1024**2):.2f} MB")
+log_info(f"CSV copy exported: {OUTPUT_PATH}")
 log_info("Feature engineering complete - ready for modeling")
 
 
@@ -1,7 +1,7 @@
 """
 E-Commerce Churn Prediction - Model Training Pipeline
 Purpose: Train supervised ML models for churn prediction using all features
-Input: data/processed/customers_features.csv
+Input: data/processed/customers_features.parquet
 Output: models/*.pkl, models/evaluation_metrics.json
 Architecture:
   - Logistic Regression wrapped in sklearn Pipeline (scaler + model)
@@ -34,7 +34,7 @@ from scipy.stats import uniform, randint, loguniform
 
 import sys
 sys.path.append(str(Path(__file__).parent.parent))
-from python.utils import log_info, log_warn, log_error
+from python.utils import log_info, log_warn, log_error, flush_logs
 
 
 # --- Load Configuration ---
@@ -43,7 +43,7 @@ config_path = Path(__file__).parent.parent.parent / "config" / "config.yaml"
 with open(config_path, 'r') as f:
     config = yaml.safe_load(f)
 
-FEATURES_PATH = Path(config['paths']['processed_data']) / "customers_features.csv"
+FEATURES_PATH = Path(config['paths']['processed_data']) / "customers_features.parquet"
 MODELS_PATH = Path(config['paths']['models'])
 MODELS_PATH.mkdir(parents=True, exist_ok=True)
 
@@ -58,7 +58,7 @@ log_info("Configuration loaded successfully")
 
 log_info("Loading customer features...")
 
-df = pd.read_csv(FEATURES_PATH, parse_dates=['first_purchase_date', 'last_purchase_date'])
+df = pd.read_parquet(FEATURES_PATH)
 
 log_info(f"Data loaded: {len(df):,} customers, {df.shape[1]} columns")
 
@@ -320,6 +320,7 @@ comparison_df = pd.DataFrame(evaluation_results).T
 comparison_df = comparison_df[['cv_roc_auc', 'roc_auc', 'accuracy', 'precision', 'recall', 'f1_score']]
 comparison_df.columns = ['CV ROC-AUC', 'Test ROC-AUC', 'Accuracy', 'Precision', 'Recall', 'F1-Score']
 
+flush_logs()  # Keep buffered logs (BATCH_LOG=1) ahead of the table
 print(comparison_df.to_string())
 
 best_model = comparison_df['Test ROC-AUC'].idxmax()
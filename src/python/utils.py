@@ -3,27 +3,56 @@ Utility Functions for Feature Engineering
 Purpose: Reusable functions for logging, validation, and data quality checks
 """
 
+import os
+import sys
+import atexit
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Tuple, Union
 
 
 # --- Logging Functions ---
+# Interactive runs print each message immediately. With BATCH_LOG=1 set
+# (e.g. scheduled runs) messages are buffered and written to stdout in a
+# single call by flush_logs(), which also runs at interpreter exit.
+
+BATCH_LOG = os.environ.get('BATCH_LOG', '').lower() in ('1', 'true', 'yes')
+_LOG_BUF: List[str] = []
+
+
+def _emit(line: str) -> None:
+    """Print a formatted log line, or buffer it when BATCH_LOG is set."""
+    if BATCH_LOG:
+        _LOG_BUF.append(line)
+    else:
+        print(line)
+
+
+def flush_logs() -> None:
+    """Write all buffered log lines to stdout in one call."""
+    if _LOG_BUF:
+        sys.stdout.write("\n".join(_LOG_BUF) + "\n")
+        sys.stdout.flush()
+        _LOG_BUF.clear()
+
+
+atexit.register(flush_logs)
+
 
 def log_info(message: str) -> None:
-    """Print INFO level log message."""
-    print(f"[INFO] {message}")
+    """Print INFO level log message (buffered when BATCH_LOG is set)."""
+    _emit(f"[INFO] {message}")
 
 
 def log_warn(message: str) -> None:
-    """Print WARN level log message."""
-    print(f"[WARN] {message}")
+    """Print WARN level log message (buffered when BATCH_LOG is set)."""
+    _emit(f"[WARN] {message}")
 
 
 def log_error(message: str) -> None:
-    """Print ERROR level log message."""
-    print(f"[ERROR] {message}")
+    """Print ERROR level log message (buffered when BATCH_LOG is set)."""
+    _emit(f"[ERROR] {message}")
 
 
 # --- Data Validation Functions ---
@@ -39,7 +68,13 @@ def validate_date_column(df: pd.DataFrame, col_name: str) -> None:
     if not pd.api.types.is_datetime64_any_dtype(df[col_name]):
         raise ValueError(f"Column '{col_name}' is not datetime type")
     
-    nat_count = df[col_name].isna().sum()
+    # np.isnat scans the raw datetime64 buffer; tz-aware columns are not
+    # backed by a datetime64 array and use the pandas NA check instead
+    values = df[col_name].to_numpy()
+    if values.dtype.kind == 'M':
+        nat_count = np.isnat(values).sum()
+    else:
+        nat_count = df[col_name].isna().sum()
     if nat_count > 0:
         log_warn(f"{nat_count} NaT values found in {col_name}")
 
@@ -59,11 +94,15 @@ def validate_no_missing_values(df: pd.DataFrame,
 def check_data_leakage(observation_df: pd.DataFrame, 
                        outcome_df: pd.DataFrame) -> None:
     """
-    Verify no temporal overlap between observation and outcome windows.
+    Verify no temporal overlap between observation and outcome windows and
+    log each window's date range (bounds are computed once and reused).
     Raises ValueError if leakage detected.
     """
-    obs_max = observation_df['invoice_date'].max()
-    outcome_min = outcome_df['invoice_date'].min()
+    obs_min, obs_max = observation_df['invoice_date'].agg(['min', 'max'])
+    outcome_min, outcome_max = outcome_df['invoice_date'].agg(['min', 'max'])
+    
+    log_info(f"Observation window: {obs_min} to {obs_max}")
+    log_info(f"Outcome window: {outcome_min} to {outcome_max}")
     
     if obs_max >= outcome_min:
         raise ValueError(
@@ -90,17 +129,22 @@ def generate_feature_report(df: pd.DataFrame) -> str:
     ]
     
     # RFM summary (updated column names)
+    # All min/max/mean statistics come from a single DataFrame.agg call
     if 'recency' in df.columns:
+        rfm_cols = ['recency', 'frequency', 'monetary_net', 'monetary_gross']
+        stats = df[rfm_cols].agg(['min', 'max', 'mean'])
         report.extend([
             "RFM Metrics:",
-            f"  Recency (days): min={df['recency'].min():.0f}, "
-            f"max={df['recency'].max():.0f}, mean={df['recency'].mean():.1f}",
-            f"  Frequency: min={df['frequency'].min():.0f}, "
-            f"max={df['frequency'].max():.0f}, mean={df['frequency'].mean():.1f}",
-            f"  Monetary Net (£): min={df['monetary_net'].min():.2f}, "
-            f"max={df['monetary_net'].max():.2f}, mean={df['monetary_net'].mean():.2f}",
-            f"  Monetary Gross (£): min={df['monetary_gross'].min():.2f}, "
-            f"max={df['monetary_gross'].max():.2f}, mean={df['monetary_gross'].mean():.2f}",
+            f"  Recency (days): min={stats.loc['min', 'recency']:.0f}, "
+            f"max={stats.loc['max', 'recency']:.0f}, mean={stats.loc['mean', 'recency']:.1f}",
+            f"  Frequency: min={stats.loc['min', 'frequency']:.0f}, "
+            f"max={stats.loc['max', 'frequency']:.0f}, mean={stats.loc['mean', 'frequency']:.1f}",
+            f"  Monetary Net (£): min={stats.loc['min', 'monetary_net']:.2f}, "
+            f"max={stats.loc['max', 'monetary_net']:.2f}, "
+            f"mean={stats.loc['mean', 'monetary_net']:.2f}",
+            f"  Monetary Gross (£): min={stats.loc['min', 'monetary_gross']:.2f}, "
+            f"max={stats.loc['max', 'monetary_gross']:.2f}, "
+            f"mean={stats.loc['mean', 'monetary_gross']:.2f}",
             ""
         ])
     
@@ -117,11 +161,15 @@ def generate_feature_report(df: pd.DataFrame) -> str:
     
     # Return statistics
     if 'has_returns' in df.columns:
-        return_pct = (df['has_returns'].sum() / len(df)) * 100
-        avg_return_rate = df['return_rate'].mean()
+        return_stats = df[['has_returns', 'return_rate']].agg(
+            {'has_returns': 'sum', 'return_rate': 'mean'}
+        )
+        n_with_returns = int(return_stats['has_returns'])
+        avg_return_rate = return_stats['return_rate']
+        return_pct = (n_with_returns / len(df)) * 100
         report.extend([
             "Return Behavior:",
-            f"  Customers with returns: {df['has_returns'].sum():,} ({return_pct:.1f}%)",
+            f"  Customers with returns: {n_with_returns:,} ({return_pct:.1f}%)",
             f"  Average return rate: {avg_return_rate:.1%}",
             ""
         ])
@@ -145,30 +193,64 @@ def generate_feature_report(df: pd.DataFrame) -> str:
 # --- Time Window Utilities ---
 
 def split_by_time_window(df: pd.DataFrame, 
-                         observation_end: str,
-                         outcome_start: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+                         observation_end: Union[str, pd.Timestamp],
+                         outcome_start: Union[str, pd.Timestamp]) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Split transactions into observation and outcome windows.
     
     Parameters:
     -----------
     df : DataFrame with 'invoice_date' column
-    observation_end : End date of observation window (exclusive), format 'YYYY-MM-DD'
-    outcome_start : Start date of outcome window (inclusive), format 'YYYY-MM-DD'
+    observation_end : End date of observation window (exclusive), 'YYYY-MM-DD' or Timestamp
+    outcome_start : Start date of outcome window (inclusive), 'YYYY-MM-DD' or Timestamp
     
     Returns:
     --------
-    observation_df, outcome_df : Tuple of DataFrames
+    observation_df, outcome_df : Tuple of DataFrames (independent of df, safe
+                                 to add columns to). Window date ranges are
+                                 logged by check_data_leakage.
+    """
+    obs_end = pd.Timestamp(observation_end)
+    out_start = pd.Timestamp(outcome_start)
+    
+    # Each window is gathered once with take(); boolean indexing followed by
+    # .copy() allocated every selected row twice
+    obs_mask = (df['invoice_date'] < obs_end).to_numpy()
+    out_mask = (df['invoice_date'] >= out_start).to_numpy()
+    
+    observation_df = df.take(np.flatnonzero(obs_mask))
+    outcome_df = df.take(np.flatnonzero(out_mask))
+    
+    return observation_df, outcome_df
+
+
+# --- Aggregation Utilities ---
+
+def count_distinct_per_group(groups: pd.Series, values: pd.Series) -> np.ndarray:
     """
-    obs_end = pd.to_datetime(observation_end)
-    out_start = pd.to_datetime(outcome_start)
+    Count distinct values per group for two categorical columns.
+    
+    Equivalent to groupby(groups)[values].nunique(), but computed on the
+    integer codes: (group, value) code pairs are combined into one int64 key,
+    sorted and de-duplicated, and the surviving pairs are counted per group.
+    No per-group hash sets are built. Missing values are ignored; groups must
+    not contain missing values.
     
-    observation_df = df[df['invoice_date'] < obs_end].copy()
-    outcome_df = df[df['invoice_date'] >= out_start].copy()
+    Parameters:
+    -----------
+    groups : Categorical Series of group keys (e.g. customer_id)
+    values : Categorical Series of values to count (same length as groups)
+    
+    Returns:
+    --------
+    counts : int64 array indexed by group category code (length = number of
+             group categories, 0 for categories with no rows)
+    """
+    group_codes = groups.cat.codes.to_numpy().astype(np.int64)
+    value_codes = values.cat.codes.to_numpy()
+    n_values = len(values.cat.categories)
     
-    log_info(f"Observation window: {observation_df['invoice_date'].min()} to "
-             f"{observation_df['invoice_date'].max()}")
-    log_info(f"Outcome window: {outcome_df['invoice_date'].min()} to "
-             f"{outcome_df['invoice_date'].max()}")
+    valid = value_codes >= 0
+    pairs = np.unique(group_codes[valid] * n_values + value_codes[valid])
     
-    return observation_df, outcome_df
\ No newline at end of file
+    return np.bincount(pairs // n_values, minlength=len(groups.cat.categories))